@@ -16,12 +16,11 @@ TODO:
 This project is licensed under the terms of the MIT license.
 """
 
-import os
 import sys
 import argparse
-import re
 import logging
 import math
+from functools import cached_property
 import numpy as np
 
 
@@ -30,29 +29,43 @@ class Conformer:
         self.index = index
         self.energy = energy
         self.relativeEnergy = 0
-        self.xyzFile = xyzFile
         self.boltzmannFactor = 0
-        self.atoms = []
         
-        # Populate the atom table, skip the two first rows
-        for row in xyzFile[2:]:
-            atomData = row.split()
-            
-            x = float(atomData[1])
-            y = float(atomData[2])
-            z = float(atomData[3])
-			
-            self.atoms.append(np.array([x,y,z]))
+        self.xyzFile = xyzFile
         
+    # Atom table as a single (N,3) array, parsed on first use from the rows after the two header rows
+    @cached_property
+    def atoms(self):
+        return parseAtomRows(self.xyzFile[2:])
+
+    # Whether the atom table has been parsed yet, checked without triggering the parse
+    def hasParsedAtoms(self):
+        return "atoms" in self.__dict__
+
     def formatxyz(self):
-        stringOutput = ""
-        for line in self.xyzFile:
-            stringOutput += line + "\n"
-        return stringOutput
+        return "\n".join(self.xyzFile) + "\n"
 
     # Distance between two cartesian cooardinates in 3D
     def distance(self, atomIndex1, atomIndex2):
-        return np.linalg.norm(self.atoms[atomIndex1] - self.atoms[atomIndex2])
+        x1, y1, z1 = self.atoms[atomIndex1].tolist()
+        x2, y2, z2 = self.atoms[atomIndex2].tolist()
+        dx, dy, dz = x1 - x2, y1 - y2, z1 - z2
+        return math.sqrt(dx*dx + dy*dy + dz*dz)
+
+    # Distances between all atom pairs as an (N,N) matrix
+    def distanceMatrix(self):
+        # Optional SIMD backend, imported here so that it is not loaded on every run
+        try:
+            import simsimd
+        except ImportError:
+            simsimd = None
+
+        if simsimd:
+            squaredDistances = np.asarray(simsimd.cdist(self.atoms, self.atoms, metric="sqeuclidean"))
+        else:
+            difference = self.atoms[:,np.newaxis] - self.atoms[np.newaxis]
+            squaredDistances = np.einsum('ijk,ijk->ij', difference, difference)
+        return np.sqrt(squaredDistances)
 
     # Angle between three cartesian coordinates in 3D
     def angle(self, atomIndex1, atomIndex2, atomIndex3):
@@ -64,16 +77,27 @@ class Conformer:
     
     # Dihedral angle between four cartesian coordinates in 3D
     def dihedral(self, atomIndex1, atomIndex2, atomIndex3, atomIndex4):
-        vector12 = -1*(self.atoms[atomIndex2] - self.atoms[atomIndex1])
-        vector32 = self.atoms[atomIndex3] - self.atoms[atomIndex2]
-        vector24 = self.atoms[atomIndex4] - self.atoms[atomIndex2]
-        vector32 /= np.linalg.norm(vector32)
-        projection12 = vector12 - np.dot(vector12, vector32)*vector32
-        projection24 = vector24 - np.dot(vector24, vector32)*vector32
-        x = np.dot(projection12, projection24)
-        y = np.dot(np.cross(vector32, projection12), projection24)
-        angle = np.arctan2(y, x)
-        return np.degrees(angle)
+        x1, y1, z1 = self.atoms[atomIndex1].tolist()
+        x2, y2, z2 = self.atoms[atomIndex2].tolist()
+        x3, y3, z3 = self.atoms[atomIndex3].tolist()
+        x4, y4, z4 = self.atoms[atomIndex4].tolist()
+        # vector12, normalized vector32 and vector24 as plain scalars
+        ax, ay, az = x1 - x2, y1 - y2, z1 - z2
+        bx, by, bz = x3 - x2, y3 - y2, z3 - z2
+        cx, cy, cz = x4 - x2, y4 - y2, z4 - z2
+        length = math.sqrt(bx*bx + by*by + bz*bz)
+        # Coinciding middle atoms leave the dihedral undefined, same as the batched version
+        if length == 0:
+            return math.nan
+        bx, by, bz = bx/length, by/length, bz/length
+        # Projections onto the plane perpendicular to vector32
+        dot = ax*bx + ay*by + az*bz
+        px, py, pz = ax - dot*bx, ay - dot*by, az - dot*bz
+        dot = cx*bx + cy*by + cz*bz
+        qx, qy, qz = cx - dot*bx, cy - dot*by, cz - dot*bz
+        x = px*qx + py*qy + pz*qz
+        y = (by*pz - bz*py)*qx + (bz*px - bx*pz)*qy + (bx*py - by*px)*qz
+        return math.degrees(math.atan2(y, x))
     
     # Degree of pyramidalization between four cartesian coordinates in 3D
     def pyramidalization(self, atomIndex1, atomIndex2, atomIndex3, atomIndex4):
@@ -84,31 +108,90 @@ class Conformer:
         # Map the values between a flat plane (360 deg) or tetrahedron (109,5*3 deg)
         return np.interp(totalAngle, [328.5,360], [1,0])
 
-# Auxiliary functions for energies
-def tokcal(e):
-    return e*627.5
+# Coordinate parsing
+def parseAtomRows(rows):
+    return np.loadtxt(rows, usecols=(1,2,3), dtype=np.float64, ndmin=2)
+
+# Batched geometry functions, operating on a (C,N,3) stack of conformer coordinates
+def stackAtoms(confList):
+    unparsed = [c for c in confList if not c.hasParsedAtoms()]
+    if not unparsed:
+        return np.stack([c.atoms for c in confList])
+
+    # Parse the atom rows of all still unparsed conformers with a single np.loadtxt call
+    parsedAtoms = parseAtomRows([row for c in unparsed for row in c.xyzFile[2:]]).reshape(len(unparsed), -1, 3)
+    if len(unparsed) == len(confList):
+        return parsedAtoms
+    parsedAtoms = iter(parsedAtoms)
+    return np.stack([c.atoms if c.hasParsedAtoms() else next(parsedAtoms) for c in confList])
+
+def distanceBatch(coordinates, atomIndex1, atomIndex2):
+    return np.linalg.norm(coordinates[:,atomIndex1] - coordinates[:,atomIndex2], axis=1)
+
+def angleBatch(coordinates, atomIndex1, atomIndex2, atomIndex3):
+    vector12 = coordinates[:,atomIndex1] - coordinates[:,atomIndex2]
+    vector23 = coordinates[:,atomIndex3] - coordinates[:,atomIndex2]
+    cosineAngle = np.einsum('ij,ij->i', vector12, vector23) / (np.linalg.norm(vector12, axis=1) * np.linalg.norm(vector23, axis=1))
+    return np.degrees(np.arccos(cosineAngle))
+
+def dihedralBatch(coordinates, atomIndex1, atomIndex2, atomIndex3, atomIndex4):
+    vector12 = coordinates[:,atomIndex1] - coordinates[:,atomIndex2]
+    vector32 = coordinates[:,atomIndex3] - coordinates[:,atomIndex2]
+    vector24 = coordinates[:,atomIndex4] - coordinates[:,atomIndex2]
+    vector32 /= np.linalg.norm(vector32, axis=1)[:,np.newaxis]
+    projection12 = vector12 - np.einsum('ij,ij->i', vector12, vector32)[:,np.newaxis]*vector32
+    projection24 = vector24 - np.einsum('ij,ij->i', vector24, vector32)[:,np.newaxis]*vector32
+    x = np.einsum('ij,ij->i', projection12, projection24)
+    y = np.einsum('ij,ij->i', np.cross(vector32, projection12), projection24)
+    return np.degrees(np.arctan2(y, x))
+
+def pyramidalizationBatch(coordinates, atomIndex1, atomIndex2, atomIndex3, atomIndex4):
+    totalAngle = (angleBatch(coordinates, atomIndex2, atomIndex1, atomIndex3)
+                  + angleBatch(coordinates, atomIndex3, atomIndex1, atomIndex4)
+                  + angleBatch(coordinates, atomIndex4, atomIndex1, atomIndex2))
+    return np.interp(totalAngle, [328.5,360], [1,0])
+
+# All conformer coordinates tiled into one contiguous (C,N,3) array
+class ConformerSet:
+    def __init__(self, conformers):
+        self.coordinates = stackAtoms(conformers)
+        
+        # Point each conformer at its slice of the shared tensor instead of a separate array
+        for c, atoms in zip(conformers, self.coordinates):
+            c.atoms = atoms
 
-def tohartree(e):
-    return e/627.5
+    def distance(self, atomIndex1, atomIndex2):
+        return distanceBatch(self.coordinates, atomIndex1, atomIndex2)
 
-def getMinimum(confList):
-    return min(confList, key=lambda c: c.energy)
+    def angle(self, atomIndex1, atomIndex2, atomIndex3):
+        return angleBatch(self.coordinates, atomIndex1, atomIndex2, atomIndex3)
 
-def conformerEnergyDifference(conf1, conf2):
-    return conf1.energy - conf2.energy
+    def dihedral(self, atomIndex1, atomIndex2, atomIndex3, atomIndex4):
+        return dihedralBatch(self.coordinates, atomIndex1, atomIndex2, atomIndex3, atomIndex4)
 
-def calculateRelativeEnergies(confList):
-    lowestConformer = getMinimum(confList)
-    for c in confList:
-        c.relativeEnergy = conformerEnergyDifference(c, lowestConformer)
+    def pyramidalization(self, atomIndex1, atomIndex2, atomIndex3, atomIndex4):
+        return pyramidalizationBatch(self.coordinates, atomIndex1, atomIndex2, atomIndex3, atomIndex4)
+
+# Auxiliary functions for energies
+KCAL_PER_HARTREE = 627.5
 
-def boltzmannDistribution(confList, temperature):
+def calculateRelativeEnergies(confList):
+    energies = np.fromiter((c.energy for c in confList), dtype=np.float64, count=len(confList))
+    lowestConformer = confList[int(energies.argmin())]
+    relativeEnergies = energies - lowestConformer.energy
+    for c, relativeEnergy in zip(confList, relativeEnergies):
+        c.relativeEnergy = float(relativeEnergy)
+    return relativeEnergies
+
+# Relative energies are expected in kcal/mol
+def boltzmannDistribution(relativeEnergies, temperature):
     R = 0.001987204
 
-    totalEnergy = sum(tokcal(c.relativeEnergy) for c in confList)
-    factorList = [math.exp(-tokcal(c.relativeEnergy/(R*temperature))) for c in confList]
-    factorSum = sum(factorList)
-    distribution = [factor/factorSum for factor in factorList]
+    exponents = -relativeEnergies/(R*temperature)
+    # Shift by the largest exponent so the dominant factor is exactly 1 and never underflows
+    exponents -= exponents.max()
+    factors = np.exp(exponents)
+    distribution = factors/factors.sum()
 
     return distribution
 
@@ -116,22 +199,30 @@ def applyCutoff(confList, energyCutoff):
     return [conformer for conformer in confList if conformer.relativeEnergy < energyCutoff]
 
 def readMultixyzFile(filename):
-    with open(filename) as f:
-        lines = f.read().splitlines()
-
     conformerList = []
-    index = 1
-    dataLength = int(lines[0]) + 2
+    dataLength = None
+    block = []
 
-    for structureRow in range(0,len(lines),dataLength):
-        conformerList.append(Conformer(int(index), float(lines[structureRow+1]), lines[structureRow:structureRow+dataLength]))
-        index += 1
+    # Stream the file and hand over each conformer block as soon as it is complete
+    with open(filename) as f:
+        for line in f:
+            block.append(line.rstrip("\r\n"))
+            if dataLength is None:
+                dataLength = int(line) + 2
+            if len(block) == dataLength:
+                conformerList.append(Conformer(len(conformerList)+1, float(block[1]), block))
+                block = []
+
+    # Anything left over besides blank lines is a truncated structure, which would skew the distribution
+    if any(block):
+        raise ValueError(f"{filename}: last structure is incomplete, expected {dataLength} lines but found {len(block)}")
 
     return conformerList
 
 def writexyzFile(conformer, filename):
     with open(filename, "w") as f:
-        f.write(conformer.formatxyz())
+        # Stream the lines straight into the file buffer instead of building the whole string
+        f.writelines(line + "\n" for line in conformer.xyzFile)
 
 class commaSeparateAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string = None):
@@ -152,6 +243,9 @@ def main(arguments):
     parser.add_argument("-p", "--pyramidalization", help = "Provides the pyramidalization degree between four atoms with given indeces. First atom is the central one.", nargs=4, type=int)
     args = parser.parse_args(arguments)
 
+    if args.temperature <= 0:
+        parser.error("argument -t/--temperature: must be above 0 K")
+
     verbose = args.verbose
     xyzFileIn = args.infile.name
     cutoff = args.cutoff
@@ -170,14 +264,16 @@ def main(arguments):
 
     logging.info(f"Successfully read in {confomerTotal} structures")
 
-    calculateRelativeEnergies(conformers)
+    relativeEnergiesKcal = calculateRelativeEnergies(conformers)*KCAL_PER_HARTREE
 
     logging.info(f"Calculating the Boltzmann distribution at {temperature} K for total of {confomerTotal} conformers...")
-    distribution = boltzmannDistribution(conformers, temperature)
+    # Stored on the conformers so the values stay attached to them when a cutoff is applied
+    for c, boltzmannFactor in zip(conformers, boltzmannDistribution(relativeEnergiesKcal, temperature)):
+        c.boltzmannFactor = float(boltzmannFactor)
 
     # Apply a cutoff and remove unnesecary conformers
     if cutoff:
-        conformers = applyCutoff(conformers, tohartree(float(cutoff)))
+        conformers = applyCutoff(conformers, float(cutoff)/KCAL_PER_HARTREE)
         logging.info(f"Applying an energy cutoff of {cutoff} kcal/mol: {len(conformers)} conformers remaining, {confomerTotal-len(conformers)} structures removed")
 
     # No exports requested?
@@ -209,33 +305,28 @@ def main(arguments):
 
         print("#\tE (Hartree)\tdE (Hartree)\tdE (kcal/mol)\tBoltzmann T={0}\t{1}".format(temperature, title))
         
-        for i, c in enumerate(conformers):
-            # Measurement data
-            data = None
+        # Measurement data for all conformers at once
+        data = None
+        if conformers and (distances or angles or dihedrals or pyramidalization):
+            conformerSet = ConformerSet(conformers)
             if distances:
-                data = c.distance(distances[0], distances[1])
+                data = conformerSet.distance(distances[0], distances[1])
             if angles:
-                data = c.angle(angles[0], angles[1], angles[2])
+                data = conformerSet.angle(angles[0], angles[1], angles[2])
             if dihedrals:
-                data = c.dihedral(dihedrals[0], dihedrals[1], dihedrals[2], dihedrals[3])
+                data = conformerSet.dihedral(dihedrals[0], dihedrals[1], dihedrals[2], dihedrals[3])
             if pyramidalization:
-                data = c.pyramidalization(pyramidalization[0], pyramidalization[1], pyramidalization[2], pyramidalization[3])
-            
-            if data:
-                print('{0:d}\t{1:f}\t{2:f}\t{3:f}\t{4:%}\t\t{5:f}'.format(
-                    c.index,
-                    c.energy,
-                    c.relativeEnergy,
-                    tokcal(c.relativeEnergy),
-                    distribution[i],
-                    data))
-            else:
-                print('{0:d}\t{1:f}\t{2:f}\t{3:f}\t{4:%}'.format(
-                    c.index,
-                    c.energy,
-                    c.relativeEnergy,
-                    tokcal(c.relativeEnergy),
-                    distribution[i]))
+                data = conformerSet.pyramidalization(pyramidalization[0], pyramidalization[1], pyramidalization[2], pyramidalization[3])
+
+        def row(c):
+            return f"{c.index:d}\t{c.energy:f}\t{c.relativeEnergy:f}\t{c.relativeEnergy*KCAL_PER_HARTREE:f}\t{c.boltzmannFactor:%}"
+
+        # Build the whole table and write it with a single call
+        if data is not None:
+            rows = (f"{row(c)}\t\t{measurement:f}\n" for c, measurement in zip(conformers, data))
+        else:
+            rows = (f"{row(c)}\n" for c in conformers)
+        sys.stdout.write("".join(rows))
 
             
     if extractionList: